@@ -9,32 +9,89 @@
 from __future__ import annotations
 
 import multiprocessing
+import os
 import pathlib
-import warnings
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import partial
 
+from typing import Any, Callable
+
 import healpy
 import numpy
-import rich.progress
-from sdssdb.peewee.sdss5db import database
+import pandas
+import pyarrow
+import pyarrow.parquet
+from sdssdb.peewee.sdss5db import catalogdb, database
 
 from lvmmag.filter import calculate_magnitudes
-from lvmmag.query import query_healpix
+from lvmmag.query import (
+    GAIA_SOURCE_ID_ORDER,
+    GAIA_SOURCE_ID_SHIFT,
+    _get_xp_query,
+    _parse_arrays,
+    query_healpix,
+)
+from lvmmag.tools import get_progress
 
 
 __all__ = ["automate"]
 
 
-def _get_fname(nside, ipix):
-    """Returns the filename associated with a HEALPix pixel."""
+# Per-process state of the pool workers.
+_WORKER: dict = {}
+
+
+def _get_fname(nside: int, ipix: int, zpad: int):
+    """Returns the filename associated with a HEALPix pixel.
+
+    ``zpad`` is the number of digits to which ``ipix`` is zero-padded.
+
+    """
+
+    return f"gaia_dr3_xp_sampled_median_spectrum_{nside}_{ipix:0{zpad}}.parquet"
+
+
+def _get_worker_connection(
+    user: str | None = None,
+    host: str | None = None,
+    port: int | None = None,
+):
+    """Returns a database connection for the current process.
+
+    The connection is created the first time it's needed and reused by later
+    tasks in the same process. Connections inherited from a parent process
+    are not reused.
+
+    """
+
+    from sdssdb import PeeweeDatabaseConnection
+
+    connection = _WORKER.get("connection", None)
 
-    zpad = int(numpy.log10(healpy.nside2npix(nside))) + 1
-    return f"gaia_dr3_xp_sampled_median_spectrum_{nside}_{ipix:0{zpad}}.h5"
+    if connection is None or _WORKER.get("pid") != os.getpid():
+        connection = PeeweeDatabaseConnection()
+        _WORKER.update({"connection": connection, "pid": os.getpid()})
+
+    if not connection.connected:
+        connection.connect("sdss5db", user=user, host=host, port=port)
+
+    return connection
+
+
+def _init_worker(
+    user: str | None = None,
+    host: str | None = None,
+    port: int | None = None,
+):
+    """Initialises a pool worker by connecting to the database."""
+
+    _get_worker_connection(user=user, host=host, port=port)
 
 
 def _query_ipix(
     nside: int,
     output_path: pathlib.Path,
+    zpad: int,
     ipix: int,
     overwrite: bool = False,
     max_gmag: float | None = None,
@@ -44,12 +101,7 @@ def _query_ipix(
 ):
     """Runs the HEALPix query for an ipix."""
 
-    from sdssdb import PeeweeDatabaseConnection
-
-    task_connection = PeeweeDatabaseConnection()
-    task_connection.connect("sdss5db", user=user, host=host, port=port)
-
-    fname = _get_fname(nside, ipix)
+    fname = _get_fname(nside, ipix, zpad)
     ipix_path = output_path / fname
 
     if ipix_path.exists():
@@ -58,23 +110,158 @@ def _query_ipix(
         else:
             ipix_path.unlink()
 
-    ipix_data = query_healpix(
+    task_connection = _get_worker_connection(user=user, host=host, port=port)
+
+    ipix_data, sflux, sflux_error = query_healpix(
         ipix,
         healpy.nside2order(nside),
         max_gmag=max_gmag,
         connection=task_connection,
+        as_arrays=True,
     )
 
-    sflux = numpy.array(ipix_data.flux.tolist())
-    mags = calculate_magnitudes(sflux, filter_type="optimistic")
+    # Nothing to write for pixels without XP spectra.
+    if len(ipix_data) == 0:
+        return
+
+    _save_ipix(ipix_path, ipix_data, sflux, sflux_error)
+
+    return
+
 
+def _save_ipix(
+    ipix_path: pathlib.Path,
+    ipix_data: pandas.DataFrame,
+    sflux: numpy.ndarray,
+    sflux_error: numpy.ndarray,
+):
+    """Calculates the magnitudes for the targets in a pixel and saves them."""
+
+    mags = calculate_magnitudes(sflux, filter_type="optimistic")
     ipix_data[["lflux", "lmag_ab", "lmag_vega"]] = mags
 
-    with warnings.catch_warnings():
-        warnings.filterwarnings("ignore")
-        ipix_data.to_hdf(str(ipix_path), "data", mode="w", complevel=9, complib="blosc")
+    # Add the spectra as fixed-size list columns backed by the 2D arrays.
+    table = pyarrow.Table.from_pandas(ipix_data)
+    for name, array in [("flux", sflux), ("flux_error", sflux_error)]:
+        values = pyarrow.array(array.ravel())
+        column = pyarrow.FixedSizeListArray.from_arrays(values, array.shape[1])
+        table = table.append_column(name, column)
+
+    # Store the float columns, including the spectra, with the byte stream split
+    # encoding. Grouping the bytes of each float by significance, as the HDF5
+    # shuffle filter does, makes the data much more compressible.
+    split_columns = []
+    for field in table.schema:
+        if pyarrow.types.is_floating(field.type):
+            split_columns.append(field.name)
+        elif pyarrow.types.is_fixed_size_list(field.type):
+            split_columns.append(f"{field.name}.list.element")
+
+    pyarrow.parquet.write_table(
+        table,
+        ipix_path,
+        compression="zstd",
+        compression_level=3,
+        use_dictionary=False,
+        use_byte_stream_split=split_columns,
+    )
 
-    return
+
+def _scan_sky(
+    nside: int,
+    output_path: pathlib.Path,
+    zpad: int,
+    on_progress: Callable[[int], Any],
+    overwrite: bool = False,
+    max_gmag: float | None = None,
+    threads: int = 5,
+    fetch_size: int = 20000,
+):
+    """Queries the XP spectra for the whole sky with a single query.
+
+    The Gaia ``source_id`` encodes the nested HEALPix index of each source, so
+    when the query is sorted by ``source_id`` the rows arrive grouped by pixel.
+    The rows are fetched in batches using a server-side cursor and each pixel is
+    saved by a pool of threads as soon as all its rows have been received.
+    ``on_progress`` is called with the number of pixels already processed.
+
+    """
+
+    Gaia_XP = catalogdb.Gaia_dr3_xp_sampled_mean_spectrum
+
+    order = healpy.nside2order(nside)
+    shift = GAIA_SOURCE_ID_SHIFT + 2 * (GAIA_SOURCE_ID_ORDER - order)
+
+    query = _get_xp_query(max_gmag=max_gmag).order_by(Gaia_XP.source_id)
+    sql, params = query.sql()
+
+    remainder: list[tuple] = []
+    pending: list[Future] = []
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        with database.atomic():
+            database.execute_sql(
+                f"DECLARE lvmmag_scan NO SCROLL CURSOR FOR {sql}", params
+            )
+
+            while True:
+                cursor = database.execute_sql(f"FETCH {fetch_size} FROM lvmmag_scan;")
+                columns = [column[0] for column in cursor.description]
+                fetched = cursor.fetchall()
+
+                rows = remainder + fetched
+                if len(rows) == 0:
+                    break
+
+                source_id_idx = columns.index("source_id")
+                source_id = numpy.array([row[source_id_idx] for row in rows])
+                ipixs = source_id >> shift
+
+                # The last pixel may continue in the next batch, unless this
+                # was the last batch.
+                if len(fetched) > 0:
+                    n_complete = int(numpy.searchsorted(ipixs, ipixs[-1]))
+                else:
+                    n_complete = len(rows)
+
+                remainder = rows[n_complete:]
+                if n_complete == 0:
+                    continue
+
+                data = pandas.DataFrame.from_records(rows[:n_complete], columns=columns)
+                sflux = _parse_arrays(data.pop("flux").values)
+                sflux_error = _parse_arrays(data.pop("flux_error").values)
+
+                # Wait for the previous batch to be saved before queuing this
+                # one to limit memory use.
+                for future in pending:
+                    future.result()
+                pending = []
+
+                ipixs = ipixs[:n_complete]
+                edges = [0, *(numpy.flatnonzero(numpy.diff(ipixs)) + 1), n_complete]
+                for start, end in zip(edges[:-1], edges[1:]):
+                    ipix_path = output_path / _get_fname(nside, ipixs[start], zpad)
+                    if ipix_path.exists() and overwrite is False:
+                        continue
+
+                    future = executor.submit(
+                        _save_ipix,
+                        ipix_path,
+                        data.iloc[start:end].reset_index(drop=True),
+                        sflux[start:end],
+                        sflux_error[start:end],
+                    )
+                    pending.append(future)
+
+                on_progress(int(ipixs[-1]) + 1)
+
+            database.execute_sql("CLOSE lvmmag_scan;")
+
+        for future in pending:
+            future.result()
+
+    on_progress(healpy.nside2npix(nside))
 
 
 def automate(
@@ -86,6 +273,8 @@ def automate(
     user: str | None = None,
     host: str | None = None,
     port: int | None = None,
+    single_query: bool = False,
+    fetch_size: int = 20000,
 ):
     """Automates the generation of LVM magnitudes.
 
@@ -110,11 +299,22 @@ def automate(
         The host on which the database server is running.
     port
         The port on which the database server is serving.
+    single_query
+        If `True`, retrieves the data for the whole sky with a single query sorted
+        by HEALPix pixel instead of running one query per pixel. The data is then
+        split into pixels as it is received and ``processes`` is the number of
+        threads used to save the pixel files. Requires ``order <= 12``.
+    fetch_size
+        The number of rows to fetch at once when ``single_query=True``.
 
     """
 
+    if single_query and order > GAIA_SOURCE_ID_ORDER:
+        raise ValueError(f"single_query requires order <= {GAIA_SOURCE_ID_ORDER}.")
+
     nside = 2**order
     n_pixels = healpy.nside2npix(nside)
+    zpad = len(str(n_pixels - 1))
 
     if not database.connected:
         database.connect(user=user, host=host, port=port)
@@ -122,24 +322,34 @@ def automate(
     if not database.connected:
         raise RuntimeError("Cannot connect to sdss5db.")
 
-    progress = rich.progress.Progress(
-        rich.progress.TextColumn("[progress.description]{task.description}"),
-        rich.progress.BarColumn(bar_width=None),
-        rich.progress.MofNCompleteColumn(),
-        rich.progress.TimeRemainingColumn(),
-        transient=False,
-        expand=True,
-        auto_refresh=True,
-    )
+    progress = get_progress(transient=False, expand=True, auto_refresh=True)
     query_task = progress.add_task("[blue]Querying ...", total=n_pixels)
     progress.start()
 
     output_path = pathlib.Path(output_path).absolute()
 
+    if single_query:
+        _scan_sky(
+            nside,
+            output_path,
+            zpad,
+            lambda n_done: progress.update(query_task, completed=n_done),
+            overwrite=overwrite,
+            max_gmag=max_gmag,
+            threads=processes,
+            fetch_size=fetch_size,
+        )
+
+        progress.update(query_task, description="[green]Querying complete")
+        progress.stop()
+
+        return
+
     _query_ipix_partial = partial(
         _query_ipix,
         nside,
         output_path,
+        zpad,
         overwrite=overwrite,
         max_gmag=max_gmag,
         user=user,
@@ -147,8 +357,18 @@ def automate(
         port=port,
     )
 
-    with multiprocessing.Pool(processes=processes) as pool:
-        for _ in pool.imap(_query_ipix_partial, list(range(n_pixels))):
+    # Send the pixels to the workers in small chunks. Each pixel is a database
+    # query so the IPC overhead is negligible, while large chunks of contiguous
+    # pixels would unbalance the load and delay the progress updates.
+    chunksize = min(16, max(1, n_pixels // processes))
+
+    with multiprocessing.Pool(
+        processes=processes,
+        initializer=_init_worker,
+        initargs=(user, host, port),
+    ) as pool:
+        pixels = range(n_pixels)
+        for _ in pool.imap_unordered(_query_ipix_partial, pixels, chunksize=chunksize):
             progress.advance(query_task)
 
     progress.update(query_task, description="[green]Querying complete")
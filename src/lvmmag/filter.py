@@ -8,22 +8,29 @@
 
 from __future__ import annotations
 
+import functools
 import pathlib
 
-from typing import cast
-
 import astropy.io.ascii
 import astropy.units
 import numpy
 from pyphot import Filter, unit
 
 
-__all__ = ["get_filter", "calculate_magnitudes"]
+__all__ = ["get_filter", "calculate_magnitudes", "calculate_magnitudes_gpu"]
+
+
+# Default wavelength sampling of xp_sampled_mean_spectrum, in Angstrom.
+_DEFAULT_WAVE_AA = numpy.arange(3360, 10200 + 20, 20, dtype=numpy.float32)
 
 
+@functools.lru_cache(maxsize=4)
 def get_filter(filter_type: str = "mean") -> Filter:
     """Returns a ``pyphot`` filter for the LVM AG filter passband.
 
+    Filters are cached so the same instance is returned for a given
+    ``filter_type``.
+
     Parameters
     ----------
     filter_type
@@ -57,6 +64,96 @@ def get_filter(filter_type: str = "mean") -> Filter:
     )
 
 
+@functools.lru_cache(maxsize=None)
+def _get_zero_points(filter_type: str = "mean"):
+    """Returns the AB and Vega zero points for a filter.
+
+    ``pyphot`` calculates the zero points each time they are accessed, which for
+    Vega requires integrating the Vega spectrum.
+
+    """
+
+    filter = get_filter(filter_type)
+
+    return float(filter.AB_zero_mag), float(filter.Vega_zero_mag)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_kernel(filter_type: str = "mean"):
+    """Returns the integration kernel for the default wavelength sampling.
+
+    For a photon-counting filter ``pyphot`` computes the flux as the ratio of the
+    trapezoidal integrals of ``wave * T * sflux`` and ``wave * T``. On a fixed
+    wavelength grid both integrals are dot products with the same weight vector,
+    so the flux for all the spectra can be calculated with a single matrix-vector
+    product. Returns the weights, their sum, and the AB and Vega zero points.
+
+    """
+
+    filter = get_filter(filter_type)
+
+    filter_wave = filter.wavelength.to("AA").magnitude
+    wave = _DEFAULT_WAVE_AA.astype(numpy.float64)
+    transmit = numpy.interp(wave, filter_wave, filter.transmit, left=0.0, right=0.0)
+
+    # Trapezoidal rule weights.
+    dwave = numpy.diff(wave)
+    trapz = numpy.zeros_like(wave)
+    trapz[:-1] += dwave / 2.0
+    trapz[1:] += dwave / 2.0
+
+    weights = wave * transmit * trapz
+
+    # The XP spectra are float32; keeping the weights in the same precision
+    # avoids promoting the spectra when calculating the product. The sum is
+    # returned as a Python float, which does not promote float32 arrays.
+    return (
+        weights.astype(numpy.float32),
+        float(weights.sum()),
+        *_get_zero_points(filter_type),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_flux_scale(flux_units: str = "W m-2 nm-1") -> float:
+    """Returns the factor to convert ``flux_units`` to erg s-1 cm-2 A-1."""
+
+    return astropy.units.Unit(flux_units).to("erg s-1 cm-2 AA-1")
+
+
+def _get_flux_array(
+    sflux: numpy.ndarray | astropy.units.Quantity,
+    flux_units: str = "W m-2 nm-1",
+) -> numpy.ndarray:
+    """Returns the flux as a 2D array in units of erg s-1 cm-2 A-1.
+
+    This is the only place where the units of the flux are handled. Arrays are
+    scaled with a float32 factor to preserve their precision.
+
+    """
+
+    # 1 W m-2 nm-1 = 100 erg s-1 cm-2 A-1
+    if isinstance(sflux, astropy.units.Quantity):
+        sflux = sflux.to_value("erg s-1 cm-2 AA-1")
+    else:
+        sflux = numpy.asarray(sflux) * numpy.float32(_get_flux_scale(flux_units))
+
+    return numpy.atleast_2d(sflux)
+
+
+def _calculate_magnitudes_raw(sflux: numpy.ndarray, filter_type: str = "mean"):
+    """Calculates the magnitudes for spectra in the default wavelength sampling.
+
+    ``sflux`` must be a 2D array in units of erg s-1 cm-2 A-1 with one spectrum
+    per row. No unit conversions or checks are done.
+
+    """
+
+    weights, norm, ab_zero_mag, vega_zero_mag = _get_kernel(filter_type)
+
+    return _fill_magnitudes(sflux @ weights / norm, ab_zero_mag, vega_zero_mag)
+
+
 def calculate_magnitudes(
     sflux: numpy.ndarray | astropy.units.Quantity,
     wave: numpy.ndarray | astropy.units.Quantity | None = None,
@@ -95,40 +192,121 @@ def calculate_magnitudes(
 
     """
 
-    sflux = numpy.atleast_2d(sflux)
-
-    if not isinstance(sflux, astropy.units.Quantity):
-        sflux *= astropy.units.Unit(flux_units)
-
-    assert isinstance(sflux, astropy.units.Quantity)
-
     # pyphot expects erg / s / cm^2 / A
-    # 1 W m-2 nm-1 = 100 erg s-1 cm-2 A-1
-    sflux = cast(astropy.units.Quantity, sflux.to("erg s-1 cm-2 AA-1"))
+    sflux = _get_flux_array(sflux, flux_units)
 
-    if wave is None:
-        wave = numpy.arange(3360, 10200 + 20, 20)
+    if wave is not None:
+        if isinstance(wave, astropy.units.Quantity):
+            wave = wave.to_value("AA")
+        else:
+            wave = numpy.asarray(wave)
 
-    if not isinstance(wave, astropy.units.Quantity):
-        wave *= astropy.units.Unit("AA")
+        # Use the precomputed kernel if the sampling is the default one.
+        if numpy.array_equal(wave, _DEFAULT_WAVE_AA):
+            wave = None
 
-    assert isinstance(wave, astropy.units.Quantity)
+    if wave is None:
+        if sflux.shape[1] != _DEFAULT_WAVE_AA.size:
+            raise ValueError("Wavelength sampling does not match flux.")
 
-    wave = cast(astropy.units.Quantity, wave.to("AA"))
+        return _calculate_magnitudes_raw(sflux, filter_type)
 
     if wave.size != sflux.shape[1]:
         raise ValueError("Wavelength sampling does not match flux.")
 
     filter = get_filter(filter_type)
 
-    wave_pyphot = wave.value * unit["AA"]
-    sflux_pyphot = sflux.value * unit["erg/s/cm**2/AA"]
+    wave_pyphot = wave * unit["AA"]
+    sflux_pyphot = sflux * unit["erg/s/cm**2/AA"]
 
     flux = filter.get_flux(wave_pyphot, sflux_pyphot, axis=1)
 
-    mag_vega = -2.5 * numpy.log10(flux) - filter.Vega_zero_mag
-    mag_ab = -2.5 * numpy.log10(flux) - filter.AB_zero_mag
+    ab_zero_mag, vega_zero_mag = _get_zero_points(filter_type)
+
+    return _fill_magnitudes(flux, ab_zero_mag, vega_zero_mag)
+
+
+def _fill_magnitudes(flux: numpy.ndarray, ab_zero_mag: float, vega_zero_mag: float):
+    """Returns the flux in W m-2 nm-1 and the AB and Vega magnitudes.
+
+    ``flux`` must be in units of erg s-1 cm-2 A-1. The columns of the output
+    array are filled in place instead of stacking and transposing the flux
+    and magnitude arrays.
+
+    """
+
+    mags = numpy.empty((flux.size, 3), dtype=flux.dtype)
+
+    numpy.divide(flux, 100, out=mags[:, 0])  # Convert flux to W m-2 nm-1
+
+    numpy.log10(flux, out=mags[:, 1])
+    mags[:, 1] *= -2.5
+    numpy.subtract(mags[:, 1], vega_zero_mag, out=mags[:, 2])
+    mags[:, 1] -= ab_zero_mag
+
+    return mags
+
+
+@functools.lru_cache(maxsize=None)
+def _get_weights_gpu(filter_type: str = "mean"):
+    """Returns the integration weights as a ``float32`` array in GPU memory."""
+
+    import cupy
+
+    weights, _, _, _ = _get_kernel(filter_type)
+
+    return cupy.asarray(weights)
+
+
+def calculate_magnitudes_gpu(
+    sflux: numpy.ndarray | astropy.units.Quantity,
+    filter_type: str = "mean",
+    flux_units="W m-2 nm-1",
+):
+    """Calculates magnitudes for spectra in the default sampling using the GPU.
+
+    Equivalent to `.calculate_magnitudes` with ``wave=None`` but the filter
+    integral is calculated on the GPU using `CuPy <https://cupy.dev>`__, which
+    must be installed. The cost of this function is dominated by the transfer
+    of the spectra to the GPU, so it is only worth it for large numbers of
+    spectra, for example when recalculating the magnitudes for many HEALPix
+    pixels at once. In that case the spectra for multiple pixels should be
+    concatenated and passed in a single call.
+
+    Parameters
+    ----------
+    sflux
+        The spectrum flux density. It can be a 1- or 2-D array (in the latter case
+        each spectrum must be a row) or an astropy quantity. The spectra must
+        be sampled on the default wavelength grid for ``xp_sampled_mean_spectrum``.
+    filter_type
+        Either ``pessimistic``, ``optimistic``, or ``mean``.
+    flux_units
+        The units of the flux density. If ``flux`` is a quantity with units,
+        this parameter is ignored.
+
+    Returns
+    -------
+    magnitudes
+        A 2D array with the flux, AB, and Vega synthetic magnitudes. See
+        `.calculate_magnitudes`.
+
+    """
+
+    try:
+        import cupy
+    except ImportError:
+        raise ImportError("calculate_magnitudes_gpu requires cupy.")
+
+    sflux = _get_flux_array(sflux, flux_units)
+    if sflux.shape[1] != _DEFAULT_WAVE_AA.size:
+        raise ValueError("Wavelength sampling does not match flux.")
+
+    _, norm, ab_zero_mag, vega_zero_mag = _get_kernel(filter_type)
+
+    sflux_gpu = cupy.asarray(sflux, dtype=cupy.float32)
+    flux_gpu = sflux_gpu @ _get_weights_gpu(filter_type)
 
-    flux_W = flux / 100  # Convert flux to W m-2 nm-1
+    flux = cupy.asnumpy(flux_gpu) / norm
 
-    return numpy.vstack((flux_W, mag_ab, mag_vega)).T
+    return _fill_magnitudes(flux, ab_zero_mag, vega_zero_mag)
@@ -10,19 +10,48 @@ from __future__ import annotations
 
 import multiprocessing
 import pathlib
+import struct
 import warnings
 from functools import partial
-from io import StringIO
 
-import pandas
+from typing import Iterator
+
+import numpy
 import peewee
-import rich.progress
+import pyarrow
+import pyarrow.parquet
+
+from lvmmag.tools import get_progress
 
 
 __all__ = ["ingest"]
 
 
-COLUMNS = ["source_id", "ra", "dec", "lflux", "lmag_ab", "lmag_vega"]
+# Columns to load and their PostgreSQL types as big-endian numpy dtypes.
+COLUMN_TYPES = {
+    "source_id": ">i8",
+    "ra": ">f8",
+    "dec": ">f8",
+    "lflux": ">f4",
+    "lmag_ab": ">f4",
+    "lmag_vega": ">f4",
+}
+
+COLUMNS = list(COLUMN_TYPES)
+
+# Layout of a row without nulls in the PostgreSQL binary COPY format: the number
+# of fields followed by the byte length and value of each field.
+_COPY_ROW_DTYPE = numpy.dtype(
+    [("n_fields", ">i2")]
+    + [
+        field
+        for column, dtype in COLUMN_TYPES.items()
+        for field in [(f"{column}_size", ">i4"), (column, dtype)]
+    ]
+)
+
+_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+_COPY_TRAILER = struct.pack(">h", -1)
 
 
 def _get_connection(
@@ -51,8 +80,94 @@ def _get_connection(
     return conn
 
 
-def _load_file(
-    file_: str | pathlib.Path,
+def _encode_batch(batch: pyarrow.RecordBatch) -> bytes:
+    """Encodes a record batch as rows in the PostgreSQL binary COPY format.
+
+    Null values are read as NaN and loaded as ``NULL``. Rows without nulls all
+    have the same layout and are encoded at once as a structured array. Rows
+    with nulls are encoded one by one after them, so the order of the rows in
+    the batch is not preserved.
+
+    """
+
+    data = {col: batch.column(col).to_numpy(zero_copy_only=False) for col in COLUMNS}
+
+    null = numpy.zeros(batch.num_rows, dtype=bool)
+    for column, values in data.items():
+        if values.dtype.kind == "f":
+            null |= numpy.isnan(values)
+
+    rows = numpy.empty(int((~null).sum()), dtype=_COPY_ROW_DTYPE)
+    rows["n_fields"] = len(COLUMNS)
+    for column, dtype in COLUMN_TYPES.items():
+        rows[f"{column}_size"] = numpy.dtype(dtype).itemsize
+        rows[column] = data[column][~null]
+
+    encoded = [rows.tobytes()]
+
+    for idx in numpy.flatnonzero(null):
+        encoded.append(struct.pack(">h", len(COLUMNS)))
+        for column, dtype in COLUMN_TYPES.items():
+            value = data[column][idx]
+            if numpy.isnan(value):
+                encoded.append(struct.pack(">i", -1))
+            else:
+                value = numpy.array(value, dtype=dtype)
+                encoded.append(struct.pack(">i", value.itemsize) + value.tobytes())
+
+    return b"".join(encoded)
+
+
+class _CopyStream:
+    """A file-like object that reads from an iterator of ``bytes`` chunks.
+
+    Used to stream data to ``cursor.copy_expert`` without holding the whole
+    payload in memory.
+
+    """
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._buffer = b""
+        self._pos = 0
+
+    def read(self, size: int = -1) -> bytes:
+        while self._pos >= len(self._buffer):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return b""
+            self._buffer = chunk
+            self._pos = 0
+
+        if size < 0:
+            size = len(self._buffer) - self._pos
+
+        data = self._buffer[self._pos : self._pos + size]
+        self._pos += len(data)
+
+        return data
+
+
+def _iter_copy_chunks(files: list[pathlib.Path], batch_size: int = 65536):
+    """Yields the binary COPY payload for a list of files.
+
+    The data for all the files is sent as a single COPY stream, one record batch
+    at a time.
+
+    """
+
+    yield _COPY_HEADER
+
+    for file_ in files:
+        parquet_file = pyarrow.parquet.ParquetFile(file_)
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=COLUMNS):
+            yield _encode_batch(batch)
+
+    yield _COPY_TRAILER
+
+
+def _load_files(
+    files: list[str | pathlib.Path],
     table_name: str = "lvm_magnitude",
     schema: str = "catalogdb",
     dbname: str = "sdss5db",
@@ -60,7 +175,13 @@ def _load_file(
     host: str | None = None,
     port: int | None = None,
 ):
-    """Loads a file to the database."""
+    """Loads a list of files to the database with a single COPY and commit.
+
+    If the COPY fails, the files are loaded again one by one so that only the
+    files with errors are skipped. Returns the number of files processed and
+    the list of files that could not be loaded.
+
+    """
 
     conn = _get_connection(
         table_name=table_name,
@@ -72,25 +193,111 @@ def _load_file(
         check_table=False,
     )
 
-    file_ = pathlib.Path(file_)
-    if not file_.exists():
-        warnings.warn(f"File {file_!s} not found.", UserWarning)
-        return
+    failed: list[str] = []
 
-    data = pandas.read_hdf(file_)
-    data = data.loc[:, COLUMNS]
+    paths: list[pathlib.Path] = []
+    for file_ in map(pathlib.Path, files):
+        if not file_.exists():
+            warnings.warn(f"File {file_!s} not found.", UserWarning)
+            failed.append(str(file_))
+        else:
+            paths.append(file_)
+
+    if len(paths) == 0:
+        return len(files), failed
 
     cursor = conn.cursor()
 
+    columns = ", ".join(f'"{column}"' for column in COLUMNS)
+    copy_sql = f"COPY {schema}.{table_name} ({columns}) FROM STDIN WITH BINARY"
+
     try:
-        with StringIO() as ss:
-            data.to_csv(ss, index=False)
-            ss.seek(0)
-            cursor.copy_expert(f"COPY {schema}.{table_name} FROM STDIN cSV HEADER", ss)
-    except Exception as err:
-        warnings.warn(f"Failed copying file {file_!s}: {err}")
-    finally:
+        cursor.copy_expert(copy_sql, _CopyStream(_iter_copy_chunks(paths)))
+    except Exception:
+        conn.rollback()
+    else:
         conn.commit()
+        return len(files), failed
+
+    # Find the files that cause the batch to fail and load the rest.
+    for path in paths:
+        try:
+            cursor.copy_expert(copy_sql, _CopyStream(_iter_copy_chunks([path])))
+        except Exception as err:
+            conn.rollback()
+            warnings.warn(f"Failed copying file {path!s}: {err}", UserWarning)
+            failed.append(str(path))
+        else:
+            conn.commit()
+
+    return len(files), failed
+
+
+def _create_staging_table(
+    conn: peewee.PostgresqlDatabase,
+    table_name: str,
+    staging_table: str,
+    schema: str = "catalogdb",
+    drop_staging: bool = False,
+):
+    """Creates an empty unlogged copy of a table to load the data into.
+
+    If the staging table already exists it may contain data from a previous run
+    that was not merged, so an error is raised unless ``drop_staging=True``.
+
+    """
+
+    if conn.table_exists(staging_table, schema):
+        if not drop_staging:
+            raise ValueError(
+                f"Table {schema}.{staging_table} already exists. It may contain "
+                "data from a previous run that was not merged. Use "
+                "drop_staging=True to drop it."
+            )
+        conn.execute_sql(f"DROP TABLE {schema}.{staging_table};")
+
+    conn.execute_sql(
+        f"CREATE UNLOGGED TABLE {schema}.{staging_table} "
+        f"(LIKE {schema}.{table_name} INCLUDING DEFAULTS);"
+    )
+
+
+def _merge_staging_table(
+    conn: peewee.PostgresqlDatabase,
+    table_name: str,
+    staging_table: str,
+    schema: str = "catalogdb",
+):
+    """Moves the data from the staging table into the final table.
+
+    Indexes on the final table that do not back a constraint are dropped before
+    inserting the data and recreated afterwards, so that they are built once
+    instead of being updated for each row. Everything happens in a single
+    transaction and the staging table is dropped at the end.
+
+    """
+
+    indexes = conn.execute_sql(
+        "SELECT i.indexname, i.indexdef FROM pg_indexes i "
+        "WHERE i.schemaname = %s AND i.tablename = %s AND NOT EXISTS "
+        "(SELECT 1 FROM pg_constraint c WHERE c.conindid = "
+        "(quote_ident(i.schemaname) || '.' || quote_ident(i.indexname))::regclass);",
+        (schema, table_name),
+    ).fetchall()
+
+    with conn.atomic():
+        for index_name, _ in indexes:
+            conn.execute_sql(f'DROP INDEX {schema}."{index_name}";')
+
+        conn.execute_sql(
+            f"INSERT INTO {schema}.{table_name} "
+            f"SELECT * FROM {schema}.{staging_table};"
+        )
+
+        for _, index_def in indexes:
+            conn.execute_sql(f"{index_def};")
+
+        conn.execute_sql(f"DROP TABLE {schema}.{staging_table};")
 
 
 def ingest(
@@ -104,6 +311,9 @@ def ingest(
     user: str | None = None,
     host: str | None = None,
     port: int | None = None,
+    batch_size: int = 100,
+    staging: bool = False,
+    drop_staging: bool = False,
 ):
     """Loads a list of processed files with LVM magnitude information into the DB.
 
@@ -131,11 +341,23 @@ def ingest(
         The host on which the database server is running.
     port
         The port on which the database server is serving.
+    batch_size
+        Number of files to load in each COPY transaction. If a batch fails to
+        load, its files are loaded one by one. The files that cannot be loaded
+        are skipped and a `RuntimeError` listing them is raised at the end.
+    staging
+        If `True`, the files are first loaded into an unlogged staging table,
+        ``<table_name>_staging``, and then inserted into ``table_name`` in a single
+        transaction, with its indexes rebuilt after the insert. If any file
+        fails to load, the staging table is not merged and is kept.
+    drop_staging
+        Whether to drop the staging table if it already exists, for example
+        after a failed run. If `False` and the table exists, an error is raised.
 
     """
 
     # Check the connection.
-    _get_connection(
+    conn = _get_connection(
         table_name=table_name,
         schema=schema,
         dbname=dbname,
@@ -155,9 +377,23 @@ def ingest(
     if len(files) == 0:
         raise ValueError("No files found.")
 
-    _load_file_partial = partial(
-        _load_file,
-        table_name=table_name,
+    batches = [files[ii : ii + batch_size] for ii in range(0, len(files), batch_size)]
+
+    if staging:
+        load_table = f"{table_name}_staging"
+        _create_staging_table(
+            conn,
+            table_name,
+            load_table,
+            schema=schema,
+            drop_staging=drop_staging,
+        )
+    else:
+        load_table = table_name
+
+    _load_files_partial = partial(
+        _load_files,
+        table_name=load_table,
         schema=schema,
         dbname=dbname,
         user=user,
@@ -165,23 +401,33 @@ def ingest(
         port=port,
     )
 
-    progress_args = (
-        rich.progress.TextColumn("[progress.description]{task.description}"),
-        rich.progress.BarColumn(bar_width=None),
-        rich.progress.MofNCompleteColumn(),
-        rich.progress.TimeRemainingColumn(),
-    )
-
-    with rich.progress.Progress(
-        *progress_args,
-        transient=False,
-        expand=True,
-        auto_refresh=True,
-    ) as progress:
+    with get_progress(transient=False, expand=True, auto_refresh=True) as progress:
         p_task = progress.add_task("[blue]Ingesting data ...", total=len(files))
 
-        with multiprocessing.Pool(processes=processes) as pool:
-            for _ in pool.imap_unordered(_load_file_partial, files):
-                progress.advance(p_task)
+        failed: list[str] = []
 
-        progress.update(p_task, description="[green]Ingestion complete")
+        with multiprocessing.Pool(processes=processes) as pool:
+            results = pool.imap_unordered(_load_files_partial, batches)
+            for n_files, batch_failed in results:
+                progress.advance(p_task, n_files)
+                failed += batch_failed
+
+        if len(failed) > 0:
+            progress.update(p_task, description="[red]Ingestion failed")
+        else:
+            if staging:
+                description = "[blue]Merging staging table ..."
+                progress.update(p_task, description=description)
+                _merge_staging_table(conn, table_name, load_table, schema=schema)
+
+            progress.update(p_task, description="[green]Ingestion complete")
+
+    if len(failed) > 0:
+        failed_list = "\n".join(sorted(failed))
+        message = f"{len(failed)} files could not be loaded:\n{failed_list}"
+        if staging:
+            message += (
+                f"\nThe staging table {schema}.{load_table} has not been merged "
+                f"into {schema}.{table_name} and has been kept."
+            )
+        raise RuntimeError(message)
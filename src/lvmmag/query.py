@@ -10,9 +10,12 @@
 
 from __future__ import annotations
 
+from io import BytesIO
+
 import healpy
 import numpy
 import pandas
+import peewee
 from sdssdb.connection import PeeweeDatabaseConnection
 from sdssdb.peewee.sdss5db import catalogdb, database
 
@@ -20,6 +23,40 @@ from sdssdb.peewee.sdss5db import catalogdb, database
 __all__ = ["cone_search", "query_healpix"]
 
 
+# Gaia source_ids encode the nested HEALPix index of the source at order 12
+# as source_id // 2**35.
+GAIA_SOURCE_ID_ORDER = 12
+GAIA_SOURCE_ID_SHIFT = 35
+
+
+def _parse_arrays(values: numpy.ndarray) -> numpy.ndarray:
+    """Parses ``[x1, x2, ...]`` string arrays into a 2D ``float32`` array.
+
+    All the arrays are joined and parsed at once, so they must have the same
+    length. Each array becomes a row in the output.
+
+    """
+
+    if len(values) == 0:
+        return numpy.empty((0, 0), dtype=numpy.float32)
+
+    # Check the length of each array before joining them, otherwise arrays with
+    # different lengths could be reshaped into misaligned rows.
+    n_commas = {value.count(",") for value in values}
+    if len(n_commas) != 1:
+        raise ValueError("String arrays do not have the same length.")
+
+    n_elements = n_commas.pop() + 1
+
+    data = ",".join([value[1:-1] for value in values])
+    parsed = numpy.fromstring(data, sep=",", dtype=numpy.float32)
+
+    if parsed.size != len(values) * n_elements:
+        raise ValueError("Failed parsing string arrays.")
+
+    return parsed.reshape(len(values), n_elements)
+
+
 def cone_search(
     ra: float,
     dec: float,
@@ -30,6 +67,7 @@ def cone_search(
     port: int | None = None,
     connection: PeeweeDatabaseConnection | None = None,
     work_mem="20GB",
+    as_arrays: bool = False,
 ):
     """Retrieves XP spectra information around RA/Dec coordinates.
 
@@ -58,6 +96,10 @@ def cone_search(
     work_mem
         The value to which to set the PostgreSQL ``work_mem`` parameter during
         the transaction.
+    as_arrays
+        If `True`, the ``flux`` and ``flux_error`` columns are not added to the
+        data frame and are instead returned as 2D ``float32`` arrays with one
+        spectrum per row.
 
     Returns
     -------
@@ -66,11 +108,33 @@ def cone_search(
         all the columns in ``xp_sampled_mean_spectrum`` (see
         https://gea.esac.esa.int/archive/documentation/GDR3/Gaia_archive/chap_datamodel/sec_dm_spectroscopic_tables/ssec_dm_xp_sampled_mean_spectrum.html)
         as well as ``phot_g_mean_mag``, ``phot_bp_mean_mag``, and ``phot_rp_mean_mag``.
+        If ``as_arrays=True``, a tuple of the data frame and the flux and flux
+        error arrays.
 
     """
 
-    Gaia_DR3 = catalogdb.Gaia_DR3
-    Gaia_XP = catalogdb.Gaia_dr3_xp_sampled_mean_spectrum
+    connection = _get_connection(connection, user=user, host=host, port=port)
+
+    # The model fields are reflected on connection so the condition must
+    # be created after connecting.
+    condition = catalogdb.Gaia_DR3.cone_search(ra, dec, radius)
+
+    return _query_xp(
+        condition,
+        connection,
+        max_gmag=max_gmag,
+        work_mem=work_mem,
+        as_arrays=as_arrays,
+    )
+
+
+def _get_connection(
+    connection: PeeweeDatabaseConnection | None = None,
+    user: str | None = None,
+    host: str | None = None,
+    port: int | None = None,
+):
+    """Returns the connection to use, connecting the default one if needed."""
 
     if connection is None:
         if not database.connected:
@@ -81,37 +145,82 @@ def cone_search(
 
         connection = database
 
-    else:
-        Gaia_DR3._meta.database = connection
-        Gaia_XP._meta.database = connection
+    return connection
 
-    query = (
-        Gaia_DR3.select(
-            Gaia_XP,
-            Gaia_DR3.phot_g_mean_mag,
-            Gaia_DR3.phot_bp_mean_mag,
-            Gaia_DR3.phot_rp_mean_mag,
-        )
-        .join(
-            Gaia_XP,
-            on=(Gaia_XP.source_id == Gaia_DR3.source_id),
-        )
-        .where(Gaia_DR3.cone_search(ra, dec, radius))
+
+def _get_xp_query(
+    condition: peewee.Expression | None = None,
+    max_gmag: float | None = None,
+):
+    """Returns the query for the XP spectra and Gaia photometry of the targets."""
+
+    Gaia_DR3 = catalogdb.Gaia_DR3
+    Gaia_XP = catalogdb.Gaia_dr3_xp_sampled_mean_spectrum
+
+    query = Gaia_DR3.select(
+        Gaia_XP,
+        Gaia_DR3.phot_g_mean_mag,
+        Gaia_DR3.phot_bp_mean_mag,
+        Gaia_DR3.phot_rp_mean_mag,
+    ).join(
+        Gaia_XP,
+        on=(Gaia_XP.source_id == Gaia_DR3.source_id),
     )
 
+    if condition is not None:
+        query = query.where(condition)
+
     if max_gmag is not None:
         query = query.where(Gaia_DR3.phot_g_mean_mag <= max_gmag)
 
-    with connection.atomic():
-        connection.execute_sql(f'SET LOCAL work_mem = "{work_mem}";')
-        df = pandas.DataFrame.from_records(query.dicts())
+    return query
+
+
+def _query_xp(
+    condition: peewee.Expression,
+    connection: PeeweeDatabaseConnection,
+    max_gmag: float | None = None,
+    work_mem="20GB",
+    as_arrays: bool = False,
+):
+    """Retrieves XP spectra for the targets matching a condition.
+
+    See `.cone_search` for details on the parameters and the returned data.
+
+    """
+
+    models = [catalogdb.Gaia_DR3, catalogdb.Gaia_dr3_xp_sampled_mean_spectrum]
+
+    # Bind the models to the connection only while the query runs instead of
+    # replacing the database of the shared model classes.
+    with connection.bind_ctx(models, bind_refs=False, bind_backrefs=False):
+        query = _get_xp_query(condition, max_gmag=max_gmag)
 
-    if len(df) == 0:
-        return df
+        with connection.atomic():
+            connection.execute_sql(f'SET LOCAL work_mem = "{work_mem}";')
+
+            # Stream the results with COPY and parse them with the pandas C parser
+            # instead of building a dictionary for each row.
+            cursor = connection.cursor()
+            sql = cursor.mogrify(*query.sql()).decode()
+
+            with BytesIO() as buffer:
+                cursor.copy_expert(f"COPY ({sql}) TO STDOUT WITH CSV HEADER", buffer)
+                buffer.seek(0)
+
+                # The default float parser can be off by one ulp; ra and dec are
+                # double precision and must be read exactly.
+                df = pandas.read_csv(buffer, float_precision="round_trip")
 
     # Convert string arrays to numpy arrays.
-    for col in ["flux", "flux_error"]:
-        df[col] = df[col].apply(lambda x: numpy.array(eval(x), dtype=numpy.float32))
+    flux = _parse_arrays(df.pop("flux").values)
+    flux_error = _parse_arrays(df.pop("flux_error").values)
+
+    if as_arrays:
+        return df, flux, flux_error
+
+    df["flux"] = list(flux)
+    df["flux_error"] = list(flux_error)
 
     return df
 
@@ -122,16 +231,22 @@ def query_healpix(ipix: int, order: int, nest: bool = True, **cone_search_kwargs
     Works similarly to `.cone_search` but returns a data frame with the spectra
     for targets that belong to a given HEALPix pixel.
 
-    This function is less efficient that `.cone_search` because it first does
-    a RA/Dec cone search with a radius that includes the HEALPix pixel, then
-    rejects targets not in the pixel. However, it's a convenient way to tessellate
-    the entire sphere, especially for multiprocessing.
+    For nested pixels with ``order <= 12`` the selection is done in the database
+    using the HEALPix index encoded in the Gaia ``source_id``, which maps each
+    pixel to a contiguous range of ``source_id`` values. The encoded index was
+    calculated by Gaia from an early position of the source, so a small number
+    of targets very close to a pixel boundary may be assigned to a different
+    pixel than the one derived from their DR3 coordinates, but the pixels still
+    tessellate the sphere without duplicates or gaps.
+
+    Otherwise this function first does a RA/Dec cone search with a radius that
+    includes the HEALPix pixel and then rejects targets not in the pixel.
 
     Parameters
     ----------
     ipix
         The pixel index.
-    nside
+    order
         The HEALPix order parameter.
     nest
         Whether to use nest pixel ordering or ring.
@@ -141,11 +256,43 @@ def query_healpix(ipix: int, order: int, nest: bool = True, **cone_search_kwargs
     Returns
     -------
     data
-        A Pandas data frame with the spectra for the matching targets.
-        See `.cone_search` for more details.
+        A Pandas data frame with the spectra for the matching targets, or a tuple
+        with the data frame and the flux and flux error arrays if ``as_arrays=True``
+        is passed. See `.cone_search` for more details.
 
     """
 
+    if nest and order <= GAIA_SOURCE_ID_ORDER:
+        connection = _get_connection(
+            cone_search_kwargs.get("connection", None),
+            user=cone_search_kwargs.get("user", None),
+            host=cone_search_kwargs.get("host", None),
+            port=cone_search_kwargs.get("port", None),
+        )
+
+        Gaia_DR3 = catalogdb.Gaia_DR3
+        Gaia_XP = catalogdb.Gaia_dr3_xp_sampled_mean_spectrum
+
+        shift = GAIA_SOURCE_ID_SHIFT + 2 * (GAIA_SOURCE_ID_ORDER - order)
+        min_source_id = int(ipix) << shift
+        max_source_id = (int(ipix) + 1) << shift
+
+        # Constrain both tables so that the planner can use either index.
+        condition = (
+            (Gaia_DR3.source_id >= min_source_id)
+            & (Gaia_DR3.source_id < max_source_id)
+            & (Gaia_XP.source_id >= min_source_id)
+            & (Gaia_XP.source_id < max_source_id)
+        )
+
+        return _query_xp(
+            condition,
+            connection,
+            max_gmag=cone_search_kwargs.get("max_gmag", None),
+            work_mem=cone_search_kwargs.get("work_mem", "20GB"),
+            as_arrays=cone_search_kwargs.get("as_arrays", False),
+        )
+
     nside = 2**order
 
     # Centre of the pixel.
@@ -156,13 +303,19 @@ def query_healpix(ipix: int, order: int, nest: bool = True, **cone_search_kwargs
     radius = healpy.max_pixrad(nside, degrees=True)
 
     cone_search_kwargs.update({"ra": ra, "dec": dec, "radius": radius})
-    data = cone_search(**cone_search_kwargs)
+    results = cone_search(**cone_search_kwargs)
 
+    data = results[0] if isinstance(results, tuple) else results
     if len(data) == 0:
-        return data
+        return results
 
     # Get the ipix for each one of the returned targets.
     data_ipix = healpy.ang2pix(nside, data.ra, data.dec, nest=nest, lonlat=True)
 
     # Select only those targets with matching ipix
-    return data.loc[data_ipix == ipix]
+    mask = data_ipix == ipix
+    if isinstance(results, tuple):
+        _, flux, flux_error = results
+        return data.loc[mask], flux[mask], flux_error[mask]
+
+    return data.loc[mask]
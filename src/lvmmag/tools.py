@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Author: José Sánchez-Gallego (gallegoj@uw.edu)
+# @Date: 2023-08-24
+# @Filename: tools.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+from __future__ import annotations
+
+import sys
+
+import rich.progress
+import rich.text
+
+
+__all__ = ["get_progress"]
+
+
+class CounterProgress:
+    """A minimal replacement for `rich.progress.Progress` for non-interactive runs.
+
+    Implements the subset of the ``Progress`` interface used in this package.
+    Instead of rendering a progress bar, a line with the number of completed
+    items is printed to ``stderr`` every ``interval`` items.
+
+    """
+
+    def __init__(self, interval: int = 1024):
+        self.interval = interval
+        self.tasks: dict[int, dict] = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def add_task(self, description: str, total: float | None = None) -> int:
+        task_id = len(self.tasks)
+        self.tasks[task_id] = {
+            "description": description,
+            "total": total,
+            "completed": 0,
+            "reported": 0,
+        }
+
+        return task_id
+
+    def advance(self, task_id: int, advance: float = 1):
+        self.update(task_id, completed=self.tasks[task_id]["completed"] + advance)
+
+    def update(
+        self,
+        task_id: int,
+        *,
+        completed: float | None = None,
+        description: str | None = None,
+    ):
+        task = self.tasks[task_id]
+
+        if description is not None:
+            task["description"] = description
+            self._report(task)
+
+        if completed is not None:
+            task["completed"] = completed
+            if completed // self.interval > task["reported"] // self.interval:
+                self._report(task)
+
+    def _report(self, task: dict):
+        description = rich.text.Text.from_markup(task["description"]).plain
+        total = task["total"]
+
+        if total is None:
+            message = f"{description} {task['completed']:.0f}"
+        else:
+            message = f"{description} {task['completed']:.0f}/{total:.0f}"
+
+        print(message, file=sys.stderr, flush=True)
+        task["reported"] = task["completed"]
+
+
+def get_progress(**kwargs) -> rich.progress.Progress | CounterProgress:
+    """Returns a progress bar for long running tasks.
+
+    If ``stderr`` is a terminal, returns a `rich.progress.Progress` instance
+    with the columns used in this package and ``kwargs`` passed to it. Otherwise,
+    for example for batch runs with redirected output, returns a
+    `.CounterProgress` that periodically prints the number of completed items,
+    avoiding the cost of rendering the progress bar.
+
+    """
+
+    if not sys.stderr.isatty():
+        return CounterProgress()
+
+    return rich.progress.Progress(
+        rich.progress.TextColumn("[progress.description]{task.description}"),
+        rich.progress.BarColumn(bar_width=None),
+        rich.progress.MofNCompleteColumn(),
+        rich.progress.TimeRemainingColumn(),
+        **kwargs,
+    )
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Author: José Sánchez-Gallego (gallegoj@uw.edu)
+# @Date: 2023-08-24
+# @Filename: test_automate.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+from __future__ import annotations
+
+import contextlib
+import importlib
+import pathlib
+
+import numpy
+import pyarrow.parquet
+import pytest
+
+from lvmmag.filter import _DEFAULT_WAVE_AA
+
+
+# lvmmag.automate is shadowed by the automate function in the package namespace.
+automate_module = importlib.import_module("lvmmag.automate")
+
+ORDER = 3
+N_ROWS = 2000
+
+
+class _FakeCursor:
+    def __init__(self, rows: list[tuple]):
+        self.rows = rows
+        self.description = [
+            (column,) for column in ["source_id", "ra", "dec", "flux", "flux_error"]
+        ]
+
+    def fetchall(self):
+        return self.rows
+
+
+class _FakeDatabase:
+    """A database that returns the rows of a cursor for the whole sky query."""
+
+    connected = True
+
+    def __init__(self, rows: list[tuple]):
+        self.rows = rows
+        self.position = 0
+
+    def atomic(self):
+        return contextlib.nullcontext()
+
+    def execute_sql(self, sql: str, params=None):
+        if not sql.startswith("FETCH"):
+            return _FakeCursor([])
+
+        n_rows = int(sql.split()[1])
+        rows = self.rows[self.position : self.position + n_rows]
+        self.position += n_rows
+
+        return _FakeCursor(rows)
+
+
+class _FakeQuery:
+    def order_by(self, *args):
+        return self
+
+    def sql(self):
+        return "SELECT", []
+
+
+class _FakeCatalogDB:
+    class Gaia_dr3_xp_sampled_mean_spectrum:
+        source_id = None
+
+
+@pytest.fixture()
+def source_id(monkeypatch):
+    rng = numpy.random.default_rng(42)
+
+    # Gaia source_ids with the order 12 nested HEALPix index in the upper bits.
+    source_id = numpy.sort(rng.integers(0, 12 * 4**12, N_ROWS)) << 35
+
+    flux = "[" + ",".join(["1e-17"] * _DEFAULT_WAVE_AA.size) + "]"
+    flux_error = "[" + ",".join(["1e-18"] * _DEFAULT_WAVE_AA.size) + "]"
+    rows = [(int(sid), 1.0, 2.0, flux, flux_error) for sid in source_id]
+
+    monkeypatch.setattr(automate_module, "database", _FakeDatabase(rows))
+    monkeypatch.setattr(automate_module, "catalogdb", _FakeCatalogDB)
+    monkeypatch.setattr(automate_module, "_get_xp_query", lambda **kw: _FakeQuery())
+
+    yield source_id
+
+
+def test_scan_sky(source_id: numpy.ndarray, tmp_path: pathlib.Path):
+    progress: list[int] = []
+
+    # Use a fetch size that splits pixels between batches.
+    automate_module._scan_sky(2**ORDER, tmp_path, 3, progress.append, fetch_size=97)
+
+    shift = 35 + 2 * (12 - ORDER)
+
+    files = sorted(tmp_path.glob("*.parquet"))
+    assert len(files) == len(numpy.unique(source_id >> shift))
+
+    n_rows = 0
+    for file_ in files:
+        data = pyarrow.parquet.read_table(file_).to_pandas()
+        file_ipix = int(file_.stem.split("_")[-1])
+
+        assert numpy.all(data.source_id.to_numpy() >> shift == file_ipix)
+        assert len(data.flux.iloc[0]) == _DEFAULT_WAVE_AA.size
+
+        n_rows += len(data)
+
+    assert n_rows == N_ROWS
+
+    assert progress == sorted(progress)
+    assert progress[-1] == 12 * 4**ORDER
+
+
+def test_automate_single_query(source_id: numpy.ndarray, tmp_path: pathlib.Path):
+    automate_module.automate(
+        order=ORDER,
+        processes=2,
+        output_path=tmp_path,
+        single_query=True,
+        fetch_size=500,
+    )
+
+    files = list(tmp_path.glob("*.parquet"))
+    assert len(files) == len(numpy.unique(source_id >> (35 + 2 * (12 - ORDER))))
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Author: José Sánchez-Gallego (gallegoj@uw.edu)
+# @Date: 2023-08-24
+# @Filename: test_filter.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+from __future__ import annotations
+
+import numpy
+import pytest
+
+from lvmmag.filter import _DEFAULT_WAVE_AA, calculate_magnitudes
+
+
+@pytest.mark.parametrize("filter_type", ["optimistic", "pessimistic", "mean"])
+def test_kernel_matches_pyphot(filter_type: str):
+    rng = numpy.random.default_rng(42)
+    sflux = rng.uniform(1e-18, 1e-16, (20, _DEFAULT_WAVE_AA.size))
+    sflux = sflux.astype(numpy.float32)
+
+    # Adding a point outside the filter passband forces the pyphot integration
+    # without changing the integrals, since the transmission there is zero.
+    wave = numpy.append(_DEFAULT_WAVE_AA, 10220.0)
+    sflux_pyphot = numpy.hstack((sflux, sflux[:, -1:]))
+
+    mags = calculate_magnitudes(sflux, filter_type=filter_type)
+    mags_pyphot = calculate_magnitudes(sflux_pyphot, wave, filter_type=filter_type)
+
+    assert mags.shape == (20, 3)
+    assert mags.dtype == numpy.float32
+
+    numpy.testing.assert_allclose(mags[:, 0], mags_pyphot[:, 0], rtol=1e-5)
+    numpy.testing.assert_allclose(mags[:, 1:], mags_pyphot[:, 1:], atol=1e-5)
+
+
+def test_single_spectrum():
+    sflux = numpy.full(_DEFAULT_WAVE_AA.size, 1e-17, dtype=numpy.float32)
+
+    mags = calculate_magnitudes(sflux)
+    assert mags.shape == (1, 3)
+
+
+def test_wave_mismatch():
+    sflux = numpy.ones((2, 10), dtype=numpy.float32)
+
+    with pytest.raises(ValueError):
+        calculate_magnitudes(sflux)
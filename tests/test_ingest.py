@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Author: José Sánchez-Gallego (gallegoj@uw.edu)
+# @Date: 2023-08-24
+# @Filename: test_ingest.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+from __future__ import annotations
+
+import importlib
+import pathlib
+import struct
+
+import numpy
+import pyarrow
+import pyarrow.parquet
+import pytest
+
+from lvmmag.ingest import (
+    COLUMN_TYPES,
+    COLUMNS,
+    _CopyStream,
+    _iter_copy_chunks,
+    _load_files,
+)
+
+
+def _decode_copy(data: bytes):
+    """Decodes a PostgreSQL binary COPY payload into a list of rows."""
+
+    assert data[:11] == b"PGCOPY\n\xff\r\n\x00"
+    assert struct.unpack(">ii", data[11:19]) == (0, 0)
+
+    rows = []
+    pos = 19
+
+    while True:
+        (n_fields,) = struct.unpack(">h", data[pos : pos + 2])
+        pos += 2
+
+        if n_fields == -1:
+            break
+
+        assert n_fields == len(COLUMNS)
+
+        row = []
+        for dtype in COLUMN_TYPES.values():
+            (size,) = struct.unpack(">i", data[pos : pos + 4])
+            pos += 4
+
+            if size == -1:
+                row.append(None)
+            else:
+                assert size == numpy.dtype(dtype).itemsize
+                row.append(numpy.frombuffer(data[pos : pos + size], dtype=dtype)[0])
+                pos += size
+
+        rows.append(row)
+
+    assert pos == len(data)
+
+    return rows
+
+
+def _write_file(path: pathlib.Path, source_id: list[int]):
+    """Writes a parquet file with the columns to load. The second row has nulls."""
+
+    n_rows = len(source_id)
+
+    lmag = numpy.linspace(15, 17, n_rows, dtype=numpy.float32)
+    lmag[1:2] = numpy.nan
+
+    table = pyarrow.table(
+        {
+            "source_id": numpy.array(source_id, dtype=numpy.int64),
+            "ra": numpy.linspace(1.5, 3.5, n_rows),
+            "dec": numpy.linspace(-1.25, 1.25, n_rows),
+            "lflux": numpy.linspace(1e-17, 3e-17, n_rows, dtype=numpy.float32),
+            "lmag_ab": lmag,
+            "lmag_vega": lmag - 0.5,
+            "flux": numpy.zeros(n_rows),
+        }
+    )
+
+    pyarrow.parquet.write_table(table, path)
+
+
+class _FakeCursor:
+    def __init__(self, conn: _FakeConnection):
+        self.conn = conn
+
+    def copy_expert(self, sql: str, stream: _CopyStream):
+        while chunk := stream.read(8192):
+            self.conn.pending.append(chunk)
+
+
+class _FakeConnection:
+    """A connection that records the COPY payloads that are committed."""
+
+    def __init__(self):
+        self.pending: list[bytes] = []
+        self.committed: list[bytes] = []
+
+    def cursor(self):
+        return _FakeCursor(self)
+
+    def commit(self):
+        self.committed.append(b"".join(self.pending))
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+
+def test_copy_round_trip(tmp_path: pathlib.Path):
+    path = tmp_path / "test.parquet"
+    _write_file(path, [10, 20, 30])
+
+    stream = _CopyStream(_iter_copy_chunks([path]))
+
+    chunks = []
+    while chunk := stream.read(7):
+        chunks.append(chunk)
+
+    rows = _decode_copy(b"".join(chunks))
+
+    # Rows with nulls are encoded after the rest.
+    assert [row[0] for row in rows] == [10, 30, 20]
+
+    assert rows[0][1:4] == [1.5, -1.25, numpy.float32(1e-17)]
+    assert rows[1][4:] == [17.0, 16.5]
+    assert rows[2][1:4] == [2.5, 0.0, numpy.float32(2e-17)]
+    assert rows[2][4:] == [None, None]
+
+
+def test_load_files_fallback(tmp_path: pathlib.Path, monkeypatch):
+    conn = _FakeConnection()
+
+    # lvmmag.ingest is shadowed by the ingest function in the package namespace.
+    ingest_module = importlib.import_module("lvmmag.ingest")
+    monkeypatch.setattr(ingest_module, "_get_connection", lambda **kwargs: conn)
+
+    good1 = tmp_path / "good1.parquet"
+    _write_file(good1, [1, 2])
+
+    good2 = tmp_path / "good2.parquet"
+    _write_file(good2, [3, 4])
+
+    # A file without the expected columns makes the COPY for the batch fail.
+    bad = tmp_path / "bad.parquet"
+    pyarrow.parquet.write_table(pyarrow.table({"source_id": [5, 6]}), bad)
+
+    missing = tmp_path / "missing.parquet"
+
+    with pytest.warns(UserWarning):
+        n_files, failed = _load_files([good1, bad, missing, good2])
+
+    assert n_files == 4
+    assert sorted(failed) == sorted([str(bad), str(missing)])
+
+    loaded = [[row[0] for row in _decode_copy(data)] for data in conn.committed]
+    assert loaded == [[1, 2], [3, 4]]
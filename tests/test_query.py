@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Author: José Sánchez-Gallego (gallegoj@uw.edu)
+# @Date: 2023-08-24
+# @Filename: test_query.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+from __future__ import annotations
+
+import numpy
+import pytest
+
+from lvmmag.query import _parse_arrays
+
+
+def test_parse_arrays():
+    values = numpy.array(["[1.5,2e-17,-3]", "[NaN,Infinity,-Infinity]"], dtype=object)
+
+    parsed = _parse_arrays(values)
+
+    assert parsed.dtype == numpy.float32
+    assert parsed.shape == (2, 3)
+
+    numpy.testing.assert_array_equal(
+        parsed,
+        numpy.array(
+            [[1.5, 2e-17, -3], [numpy.nan, numpy.inf, -numpy.inf]],
+            dtype=numpy.float32,
+        ),
+    )
+
+
+def test_parse_arrays_empty():
+    assert _parse_arrays(numpy.array([], dtype=object)).shape == (0, 0)
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        ["[1,2]", "[1,2,3,4]"],
+        ["[1,2,3]", "[1]", "[1,2,3,4,5]"],
+    ],
+)
+def test_parse_arrays_different_lengths(values: list[str]):
+    with pytest.raises(ValueError):
+        _parse_arrays(numpy.array(values, dtype=object))